@@ -6,25 +6,61 @@
 # 4. Access via browser: http://127.0.0.1:5000/
 # Default admin login: username='admin', password='admin'
 
-from flask import Flask, render_template, request, redirect, url_for, flash, make_response, session
+from flask import Flask, render_template, request, redirect, url_for, flash, make_response, session, abort, g
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import func, case, and_, exists, event
+from sqlalchemy.orm import joinedload, lazyload, raiseload, contains_eager
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.exc import IntegrityError
+from datetime import date, datetime, timedelta
+from functools import wraps
+from bisect import bisect_left
+import calendar
+import hashlib
+import json
 import os
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your_secret_key_here_change_in_production')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///rental.db').replace('postgres://', 'postgresql://', 1)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
-    'pool_pre_ping': True,          # Kiểm tra kết nối trước khi dùng → tự reconnect nếu chết
-    'pool_recycle': 300,            # Tái tạo kết nối sau 5 phút
-    'pool_size': 5,                 # Giữ 5 kết nối
-    'max_overflow': 10,             # Cho phép thêm 10 kết nối tạm
-    'pool_timeout': 30              # Chờ tối đa 30 giây
-}
+if not app.debug:
+    # Production: không stat lại file template mỗi lần render, cache bytecode đã biên dịch
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+    app.jinja_env.auto_reload = False
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # SQLite (chạy local): dùng chung kết nối giữa các thread của server
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'connect_args': {'check_same_thread': False},
+        'pool_pre_ping': True
+    }
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_pre_ping': True,          # Kiểm tra kết nối trước khi dùng → tự reconnect nếu chết
+        'pool_recycle': 300,            # Tái tạo kết nối sau 5 phút
+        'pool_size': 10,                # Giữ 10 kết nối cho mỗi worker
+        'max_overflow': 20,             # Cho phép thêm 20 kết nối tạm khi tải cao
+        'pool_timeout': 30              # Chờ tối đa 30 giây
+    }
 db = SQLAlchemy(app)
+
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+    # SQLite: WAL cho phép đọc song song khi đang ghi, synchronous=NORMAL giảm fsync mỗi commit,
+    # cache_size âm = KiB → giữ ~64 MB trang dữ liệu trong bộ nhớ mỗi kết nối (mặc định ~2 MB)
+    with app.app_context():
+        @event.listens_for(db.engine, 'connect')
+        def set_sqlite_pragma(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute('PRAGMA cache_size=-64000')
+            cursor.close()
+
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
@@ -32,48 +68,88 @@ login_manager.login_view = 'login'
 # VAT điện - năm 2026 là 8%, sửa ở đây nếu thay đổi sau này
 VAT_RATE = 0.08
 
+# Giá nước bậc thang: WATER_TIER1_LIMIT m³ đầu giá bậc 1, phần vượt giá bậc 2
+WATER_TIER1_LIMIT = 5
+WATER_TIER1_PRICE = 16000
+WATER_TIER2_PRICE = 27000
+
+# Hạn thanh toán hóa đơn: ngày BILL_DUE_DAY của tháng sau tháng hóa đơn
+BILL_DUE_DAY = 5
+
+# Số hóa đơn mỗi trang trên trang khách thuê (12 = 1 năm)
+BILLS_PER_PAGE = 12
+
+# Thuật toán băm mật khẩu - PBKDF2-SHA512 210.000 vòng (mức tối thiểu OWASP cho SHA512),
+# số vòng cố định để thời gian đăng nhập ổn định. Hash cũ vẫn kiểm tra được vì thuật toán
+# được lưu kèm trong chuỗi hash; chỉ hash yếu hơn mức tối thiểu mới được băm lại khi đăng nhập
+PASSWORD_HASH_METHOD = 'pbkdf2:sha512:210000'
+
+# Số vòng PBKDF2 tối thiểu theo OWASP cho từng hàm băm
+PBKDF2_MIN_ITERATIONS = {'sha1': 1300000, 'sha256': 600000, 'sha512': 210000}
+
 # ===========================================================
 
 # Models
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(150), unique=True, nullable=False)
-    password = db.Column(db.String(150), nullable=False)
-    role = db.Column(db.String(50), nullable=False)  # 'admin', 'user', 'tenant'
+    password = db.Column(db.String(255), nullable=False)  # Hash PBKDF2-SHA512 dài ~170 ký tự
+    role = db.Column(db.String(50), nullable=False, index=True)  # 'admin', 'user', 'tenant'
     
     # Thêm trường gán với khách thuê (chỉ dùng khi role = 'tenant')
-    tenant_id = db.Column(db.Integer, db.ForeignKey('tenant.id'), nullable=True)
+    tenant_id = db.Column(db.Integer, db.ForeignKey('tenant.id'), nullable=True, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    tenant = db.relationship('Tenant')
 class Room(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     rent_price = db.Column(db.Float, nullable=False)
     internet_fee = db.Column(db.Float, nullable=False, default=0.0)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    tenants = db.relationship('Tenant', back_populates='room')
 
 class Tenant(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     phone = db.Column(db.String(20))
     email = db.Column(db.String(150))
-    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False)
+    room_id = db.Column(db.Integer, db.ForeignKey('room.id'), nullable=False, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    room = db.relationship('Room', back_populates='tenants')
+    contracts = db.relationship('Contract', back_populates='tenant')
 
 class Contract(db.Model):
+    # Lọc hợp đồng còn hiệu lực (end_date >= hôm nay): theo ngày, hoặc theo khách thuê + ngày
+    __table_args__ = (
+        db.Index('ix_contract_end_date', 'end_date'),
+        db.Index('ix_contract_tenant_end', 'tenant_id', 'end_date'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     tenant_id = db.Column(db.Integer, db.ForeignKey('tenant.id'), nullable=False)
     start_date = db.Column(db.Date, nullable=False)
     duration_months = db.Column(db.Integer, nullable=False)
     end_date = db.Column(db.Date)
     is_extended = db.Column(db.Boolean, default=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    tenant = db.relationship('Tenant', back_populates='contracts')
+    bills = db.relationship('Bill', back_populates='contract')
 
 class TotalElectricityMonth(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    month = db.Column(db.Date, nullable=False)  # Ngày 1 tháng (e.g. 2026-01-01)
+    month = db.Column(db.Date, nullable=False, index=True)  # Ngày 1 tháng (e.g. 2026-01-01)
     electricity_old = db.Column(db.Float, default=0.0)  # Chỉ số tổng cũ (từ công tơ nhà)
     electricity_new = db.Column(db.Float, default=0.0)  # Chỉ số tổng mới
     total_kwh = db.Column(db.Float, default=0.0)  # Tự tính = new - old
+    total_cost_before_vat = db.Column(db.Float, default=0.0)  # Tổng tiền điện bậc thang chưa VAT (tự tính)
     average_price = db.Column(db.Float, default=0.0)  # Đơn giá trung bình chưa VAT (tự tính)
 
 class Bill(db.Model):
+    # Mỗi hợp đồng chỉ có 1 hóa đơn mỗi tháng. Index unique (contract_id, month) này cũng
+    # dùng cho lọc bill theo hợp đồng + tháng và tìm bill gần nhất (quét ngược index)
+    __table_args__ = (db.Index('uq_bill_contract_month', 'contract_id', 'month', unique=True),)
+
     id = db.Column(db.Integer, primary_key=True)
     contract_id = db.Column(db.Integer, db.ForeignKey('contract.id'), nullable=False)
     month = db.Column(db.Date, nullable=False)
@@ -90,6 +166,14 @@ class Bill(db.Model):
     water_cost = db.Column(db.Float, default=0.0)                    # Tiền nước
     total = db.Column(db.Float, nullable=False)
     paid = db.Column(db.Boolean, default=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    contract = db.relationship('Contract', back_populates='bills')
+
+    # Tiền điện chưa VAT = số kWh × đơn giá trung bình đã lưu của bill
+    # hybrid: dùng trong template (bill.electricity_cost) và trong SQL (func.sum(Bill.electricity_cost))
+    @hybrid_property
+    def electricity_cost(self):
+        return self.electricity_usage * self.average_price_before_vat
 
 class PriceTier(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -97,59 +181,72 @@ class PriceTier(db.Model):
     from_kwh = db.Column(db.Float, nullable=False)
     to_kwh = db.Column(db.Float, nullable=True)  # None = vô hạn
     price = db.Column(db.Float, nullable=False)  # Đơn giá chưa VAT
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
 # Hàm tính tiền nước (bậc thang cố định)
 def calculate_water_cost(water_usage):
-    if water_usage <= 0:
-        return 0.0
-    if water_usage <= 5:
-        return water_usage * 16000
-    else:
-        return 5 * 16000 + (water_usage - 5) * 27000
+    # Phần trong bậc 1 + phần vượt bậc 1 (không rẽ nhánh; usage <= 0 → 0)
+    first = min(max(water_usage, 0), WATER_TIER1_LIMIT)
+    rest = max(water_usage - WATER_TIER1_LIMIT, 0)
+    return float(first * WATER_TIER1_PRICE + rest * WATER_TIER2_PRICE)
+
+# Biểu thức SQL tương đương calculate_water_cost, để DB tự tính khi tổng hợp / cập nhật hàng loạt
+def water_cost_expr(water_usage):
+    return case(
+        (water_usage <= 0, 0.0),
+        (water_usage <= WATER_TIER1_LIMIT, water_usage * WATER_TIER1_PRICE),
+        else_=WATER_TIER1_LIMIT * WATER_TIER1_PRICE + (water_usage - WATER_TIER1_LIMIT) * WATER_TIER2_PRICE
+    )
+
+# Hàm cộng số tháng theo lịch (31/01 + 1 tháng → 28/02 hoặc 29/02)
+def add_months(start_date, months):
+    month_index = start_date.month - 1 + months
+    year = start_date.year + month_index // 12
+    month = month_index % 12 + 1
+    day = min(start_date.day, calendar.monthrange(year, month)[1])
+    return start_date.replace(year=year, month=month, day=day)
 
 # Hàm lấy tổng kWh điện tất cả phòng trong tháng
+# Bill.month luôn lưu ngày 01 của tháng (mọi route tạo/sửa bill đều parse 'YYYY-MM' + '-01')
+# → so sánh bằng, không cần tính khoảng đầu/cuối tháng
 def get_total_electricity_usage_in_month(month_date):
-    start = month_date.replace(day=1)
-    if month_date.month == 12:
-        end = month_date.replace(year=month_date.year + 1, month=1, day=1) - timedelta(days=1)
-    else:
-        end = month_date.replace(month=month_date.month + 1, day=1) - timedelta(days=1)
-    
-    total = db.session.query(db.func.sum(Bill.electricity_usage)).filter(
-        Bill.month.between(start, end)
+    return db.session.query(func.coalesce(func.sum(Bill.electricity_usage), 0.0)).filter(
+        Bill.month == month_date.replace(day=1)
     ).scalar()
-    return total or 0.0
+
+# Bảng giá điện bậc thang dạng cộng dồn: uppers[i] = tổng kWh tính đến hết bậc i,
+# tiers[i] = (kWh đầu bậc, tiền của các bậc trước, đơn giá) → tính tiền bằng bisect, không duyệt từng bậc.
+# Luôn đọc từ DB (mỗi request chỉ tính 1 lần): mọi worker gunicorn thấy ngay giá vừa sửa,
+# không bao giờ tính tiền (và lưu vĩnh viễn vào hóa đơn) theo bảng giá cũ
+def get_price_tiers():
+    uppers, tiers = [], []
+    lower, base = 0.0, 0.0
+    for tier in PriceTier.query.order_by(PriceTier.tier_order):
+        size = max((tier.to_kwh or float('inf')) - tier.from_kwh, 0)
+        uppers.append(lower + size)
+        tiers.append((lower, base, tier.price))
+        if size == float('inf'):
+            break
+        lower += size
+        base += size * tier.price
+    else:
+        # Vượt bậc cuối (bậc cuối có giới hạn) → không tính thêm, giữ nguyên tổng các bậc
+        uppers.append(float('inf'))
+        tiers.append((lower, base, 0.0))
+    return uppers, tiers
 
 # Hàm tính tổng tiền điện chung theo bậc thang EVN
 def calculate_total_electricity_cost_before_vat(total_kwh):
     """Tính tổng tiền điện chung (chưa VAT) theo bậc thang từ database"""
     if total_kwh <= 0:
         return 0.0
-    
-    tiers = PriceTier.query.order_by(PriceTier.tier_order).all()
-    cost = 0.0
-    remaining = total_kwh
-    
-    for tier in tiers:
-        tier_size = (tier.to_kwh or float('inf')) - tier.from_kwh
-        used = min(remaining, tier_size)
-        if used > 0:
-            cost += used * tier.price
-            remaining -= used
-        if remaining <= 0:
-            break
-    
-    return cost
 
-# Hàm tính hóa đơn mới (theo bài toán của bạn)
-def calculate_bill(contract, electricity_old, electricity_new, water_old, water_new, bill_month):
-    room = Room.query.get(Tenant.query.get(contract.tenant_id).room_id)
-
-    electricity_usage = max(electricity_new - electricity_old, 0)
-    water_usage = max(water_new - water_old, 0)
-
-    water_cost = calculate_water_cost(water_usage)
+    uppers, tiers = get_price_tiers()
+    lower, base, price = tiers[bisect_left(uppers, total_kwh)]
+    return base + (total_kwh - lower) * price
 
+# Hàm lấy đơn giá điện trung bình (chưa VAT) của tháng
+def get_average_price(bill_month, electricity_usage=0):
     # Lấy đơn giá trung bình từ bảng TotalElectricityMonth (admin đã nhập tổng điện toàn nhà)
     # Đây là cách đúng: mọi phòng trong cùng tháng đều dùng chung 1 đơn giá trung bình
     month_start = bill_month.replace(day=1) if hasattr(bill_month, 'replace') else bill_month
@@ -159,16 +256,26 @@ def calculate_bill(contract, electricity_old, electricity_new, water_old, water_
 
     if total_elec_entry and total_elec_entry.average_price > 0:
         # Dùng đơn giá trung bình đã tính sẵn từ tổng điện toàn nhà
-        average_price = total_elec_entry.average_price
-    else:
-        # Fallback: tính từ tổng bill đã có trong tháng (kém chính xác hơn)
-        # Xảy ra khi admin chưa nhập tổng điện tháng đó
-        total_kwh = get_total_electricity_usage_in_month(bill_month) + electricity_usage
-        if total_kwh == 0:
-            average_price = 0.0
-        else:
-            total_cost_before_vat = calculate_total_electricity_cost_before_vat(total_kwh)
-            average_price = total_cost_before_vat / total_kwh
+        return total_elec_entry.average_price
+
+    # Fallback: tính từ tổng bill đã có trong tháng (kém chính xác hơn)
+    # Xảy ra khi admin chưa nhập tổng điện tháng đó
+    total_kwh = get_total_electricity_usage_in_month(bill_month) + electricity_usage
+    if total_kwh == 0:
+        return 0.0
+    return calculate_total_electricity_cost_before_vat(total_kwh) / total_kwh
+
+# Hàm tính hóa đơn mới (theo bài toán của bạn)
+# room: phòng của hợp đồng (nơi gọi đã có sẵn, tránh truy vấn lại Contract → Tenant → Room)
+# average_price: truyền sẵn khi tính nhiều hóa đơn cùng tháng để không tra cứu lại
+def calculate_bill(room, electricity_old, electricity_new, water_old, water_new, bill_month, average_price=None):
+    electricity_usage = max(electricity_new - electricity_old, 0)
+    water_usage = max(water_new - water_old, 0)
+
+    water_cost = calculate_water_cost(water_usage)
+
+    if average_price is None:
+        average_price = get_average_price(bill_month, electricity_usage)
 
     if electricity_usage == 0:
         room_electricity_before_vat = 0.0
@@ -190,38 +297,209 @@ def calculate_bill(contract, electricity_old, electricity_new, water_old, water_
         'average_price_before_vat': average_price
     }
 
+# Kiểm tra mật khẩu; nếu hash cũ dùng thuật toán / số vòng khác cấu hình hiện tại thì băm lại
+def verify_password(user, password):
+    if not check_password_hash(user.password, password):
+        return False
+    if password_hash_is_weak(user.password):
+        user.password = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+        db.session.commit()
+    return True
+
+# Hash yếu = PBKDF2 ít vòng hơn mức tối thiểu của hàm băm đó, hoặc định dạng cũ không rõ số vòng.
+# scrypt (mặc định của Werkzeug 3) và PBKDF2 đủ mạnh (vd. sha256:600000) giữ nguyên, không hạ cấp
+def password_hash_is_weak(pwhash):
+    method = pwhash.split('$', 1)[0]
+    if method.startswith('scrypt'):
+        return False
+    parts = method.split(':')
+    if parts[0] != 'pbkdf2' or len(parts) != 3 or not parts[2].isdigit():
+        return True
+    return int(parts[2]) < PBKDF2_MIN_ITERATIONS.get(parts[1], float('inf'))
+
+# Khi chạy test (TESTING=True) hoặc debug: báo lỗi ngay nếu có lazy load ngoài dự kiến (N+1)
+# Production giữ lazy load bình thường
+def strict_loading():
+    return [raiseload('*')] if app.config.get('TESTING') or app.debug else []
+
+# Lấy hợp đồng kèm khách thuê + phòng bằng 1 truy vấn JOIN, 404 nếu không tồn tại
+def get_contract_or_404(contract_id, *options):
+    contract = db.session.get(
+        Contract, contract_id,
+        options=[joinedload(Contract.tenant).joinedload(Tenant.room), *options, *strict_loading()]
+    )
+    if contract is None:
+        abort(404)
+    return contract
+
+# Lấy hóa đơn kèm hợp đồng → khách thuê → phòng trong 1 truy vấn JOIN, 404 nếu không tồn tại
+def get_bill_or_404(bill_id, *options):
+    bill = db.session.get(
+        Bill, bill_id,
+        options=[joinedload(Bill.contract).joinedload(Contract.tenant).joinedload(Tenant.room), *options, *strict_loading()]
+    )
+    if bill is None:
+        abort(404)
+    return bill
+
+# Lấy khách thuê kèm phòng trong 1 truy vấn JOIN, 404 nếu không tồn tại
+def get_tenant_or_404(tenant_id):
+    tenant = db.session.get(Tenant, tenant_id, options=[joinedload(Tenant.room), *strict_loading()])
+    if tenant is None:
+        abort(404)
+    return tenant
+
+# Kiểm tra tồn tại bằng EXISTS: DB dừng ở dòng khớp đầu tiên, không dựng object ORM
+def row_exists(*criteria):
+    return db.session.query(exists().where(*criteria)).scalar()
+
+# Số lượng admin, chỉ đếm 1 lần trong mỗi request
+def get_admin_count():
+    if not hasattr(g, '_admin_count'):
+        g._admin_count = User.query.filter_by(role='admin').count()
+    return g._admin_count
+
+# ==================== HTTP CACHE (ETag) ====================
+# Phiên bản dữ liệu = (lần sửa gần nhất, số dòng) của từng nhóm dòng → thay đổi khi thêm/sửa/xóa.
+# Mỗi nhóm là 1 model (cả bảng) hoặc tuple (model, điều kiện...) để chỉ tính các dòng trang hiển thị:
+# lọc theo cột khóa ngoại có index, và thay đổi của chủ trọ khác không làm mất ETag của mình
+def data_version(*scopes):
+    columns = []
+    for scope in scopes:
+        model, *criteria = scope if isinstance(scope, tuple) else (scope,)
+        columns.append(db.select(func.max(model.updated_at)).where(*criteria).scalar_subquery())
+        columns.append(db.select(func.count(model.id)).where(*criteria).scalar_subquery())
+    return db.session.query(*columns).one()
+
+def make_etag(*parts):
+    raw = ':'.join(str(part) for part in (current_user.id, current_user.role, current_user.username, *parts))
+    return hashlib.md5(raw.encode()).hexdigest()
+
+def with_etag(response, etag):
+    response = make_response(response)
+    response.set_etag(etag)
+    # private: chỉ trình duyệt cache; no-cache: luôn hỏi lại server (trả 304 nếu không đổi)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Trả về 304 nếu trình duyệt đã có bản mới nhất; None nếu phải render lại
+# (luôn render lại khi còn flash message chưa hiển thị)
+def not_modified(etag):
+    if session.get('_flashes') or etag not in request.if_none_match:
+        return None
+    return with_etag(('', 304), etag)
+# ===========================================================
+
+# ==================== HTMX ====================
+# Request gửi từ htmx (sửa / xóa 1 dòng tại chỗ)
+def is_htmx():
+    return bool(request.headers.get('HX-Request'))
+
+# Phản hồi htmx kèm thông báo kiểu flash: header HX-Trigger phát sự kiện showMessage,
+# base.html hiển thị thành alert. swap=False → giữ nguyên dòng cũ (vd. khi dữ liệu lỗi)
+def htmx_response(body, message, category='success', swap=True):
+    response = make_response(body)
+    # ensure_ascii (mặc định): header HTTP chỉ nhận latin-1, tiếng Việt đi dưới dạng \uXXXX
+    response.headers['HX-Trigger'] = json.dumps({'showMessage': {'level': category, 'message': message}})
+    if not swap:
+        response.headers['HX-Reswap'] = 'none'
+    return response
+# ===========================================================
+
+# Bill quá hạn = chưa thanh toán và bill.month < mốc trả về
+# (đã qua ngày BILL_DUE_DAY tháng sau). So sánh thẳng trên cột month nên SQL dùng được index,
+# không phải tính hạn thanh toán cho từng bill
+def overdue_cutoff(today):
+    current_month_start = today.replace(day=1)
+    if today.day > BILL_DUE_DAY:
+        return current_month_start
+    return (current_month_start - timedelta(days=1)).replace(day=1)
+
+# Admin quản lý mọi phòng, chủ trọ chỉ quản lý phòng của mình
+def can_manage_room(room):
+    return current_user.role == 'admin' or room.user_id == current_user.id
+
+# Decorator: chỉ admin mới được vào route (đặt dưới @login_required)
+def admin_required(message='Chỉ admin mới được truy cập'):
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if current_user.role != 'admin':
+                flash(message, 'danger')
+                return redirect(url_for('dashboard'))
+            return view(*args, **kwargs)
+        return wrapped
+    return decorator
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
 # ==================== KHỞI TẠO DATABASE KHI DEPLOY ====================
 # Đặt sau Models để User, PriceTier... đã được định nghĩa
 def initialize_database():
     db.create_all()
 
-    # === MIGRATION: Thêm các cột mới vào bảng bill nếu chưa có ===
+    # === MIGRATION: Thêm các cột mới vào bảng đã tồn tại nếu chưa có ===
     # Cần thiết vì db.create_all() không tự ALTER bảng đã tồn tại
-    new_bill_columns = {
-        'average_price_before_vat':    'DOUBLE PRECISION DEFAULT 0.0',
-        'room_electricity_before_vat': 'DOUBLE PRECISION DEFAULT 0.0',
-        'electricity_vat':             'DOUBLE PRECISION DEFAULT 0.0',
-        'room_electricity_with_vat':   'DOUBLE PRECISION DEFAULT 0.0',
-        'water_cost':                  'DOUBLE PRECISION DEFAULT 0.0',
-    }
+    new_columns = [
+        ('bill', 'average_price_before_vat',    'DOUBLE PRECISION DEFAULT 0.0'),
+        ('bill', 'room_electricity_before_vat', 'DOUBLE PRECISION DEFAULT 0.0'),
+        ('bill', 'electricity_vat',             'DOUBLE PRECISION DEFAULT 0.0'),
+        ('bill', 'room_electricity_with_vat',   'DOUBLE PRECISION DEFAULT 0.0'),
+        ('bill', 'water_cost',                  'DOUBLE PRECISION DEFAULT 0.0'),
+        ('total_electricity_month', 'total_cost_before_vat', 'DOUBLE PRECISION DEFAULT 0.0'),
+        # updated_at: dùng để tính ETag cho các trang chỉ đọc
+        ('user',     'updated_at', 'TIMESTAMP'),
+        ('room',     'updated_at', 'TIMESTAMP'),
+        ('tenant',   'updated_at', 'TIMESTAMP'),
+        ('contract', 'updated_at', 'TIMESTAMP'),
+        ('bill',     'updated_at', 'TIMESTAMP'),
+        ('price_tier', 'updated_at', 'TIMESTAMP'),
+    ]
     with db.engine.connect() as conn:
-        for col_name, col_def in new_bill_columns.items():
+        for table_name, col_name, col_def in new_columns:
             try:
-                conn.execute(db.text(f'ALTER TABLE bill ADD COLUMN {col_name} {col_def}'))
+                conn.execute(db.text(f'ALTER TABLE "{table_name}" ADD COLUMN {col_name} {col_def}'))
                 conn.commit()
-                print(f"✅ Đã thêm cột bill.{col_name}")
+                print(f"✅ Đã thêm cột {table_name}.{col_name}")
             except Exception:
                 conn.rollback()  # Cột đã tồn tại → bỏ qua
+
+        # Cột password cũ VARCHAR(150) không đủ chứa hash PBKDF2-SHA512
+        # (SQLite không giới hạn độ dài VARCHAR nên chỉ cần với PostgreSQL)
+        if conn.dialect.name == 'postgresql':
+            conn.execute(db.text('ALTER TABLE "user" ALTER COLUMN password TYPE VARCHAR(255)'))
+            conn.commit()
+
+    # Bill tạo trước khi có cột water_cost → tính lại tiền nước ngay trong DB bằng 1 câu UPDATE
+    Bill.query.filter(Bill.water_cost == 0, Bill.water_usage > 0).update(
+        {Bill.water_cost: water_cost_expr(Bill.water_usage)}, synchronize_session=False
+    )
+    # Tháng nhập trước khi có cột total_cost_before_vat → tổng tiền = kWh × đơn giá trung bình đã lưu
+    TotalElectricityMonth.query.filter(
+        TotalElectricityMonth.total_cost_before_vat == 0, TotalElectricityMonth.total_kwh > 0
+    ).update(
+        {TotalElectricityMonth.total_cost_before_vat: TotalElectricityMonth.total_kwh * TotalElectricityMonth.average_price},
+        synchronize_session=False
+    )
+    db.session.commit()
+
+    # === MIGRATION: Tạo các index mới cho bảng đã tồn tại ===
+    # db.create_all() chỉ tạo index khi tạo bảng mới. Tạo index không cần thứ tự khóa ngoại
+    # → duyệt thẳng metadata.tables (sorted_tables cảnh báo vòng user ↔ tenant ↔ room)
+    for table in db.metadata.tables.values():
+        for index in table.indexes:
+            try:
+                index.create(bind=db.engine, checkfirst=True)
+            except Exception as e:
+                print(f"⚠️ Không tạo được index {index.name}: {e}")
     # =============================================================
 
-    if not User.query.filter_by(username='admin').first():
+    if not row_exists(User.username == 'admin'):
         admin = User(
             username='admin',
-            password=generate_password_hash('admin', method='pbkdf2:sha256'),
+            password=generate_password_hash('admin', method=PASSWORD_HASH_METHOD),
             role='admin'
         )
         db.session.add(admin)
@@ -239,13 +517,29 @@ def initialize_database():
             (5, 300, 400, 3350),
             (6, 400, None, 3460),
         ]
-        for order, from_kwh, to_kwh, price in tiers:
-            db.session.add(PriceTier(tier_order=order, from_kwh=from_kwh, to_kwh=to_kwh, price=price))
+        db.session.bulk_insert_mappings(PriceTier, [
+            {'tier_order': order, 'from_kwh': from_kwh, 'to_kwh': to_kwh, 'price': price}
+            for order, from_kwh, to_kwh, price in tiers
+        ])
         db.session.commit()
         print("Đã tạo bảng giá điện EVN mới nhất!")
 
-with app.app_context():
+# Chạy 1 lần ở bước deploy: flask --app flask_app init-db
+@app.cli.command('init-db')
+def init_db_command():
+    """Tạo bảng, chạy migration và tạo dữ liệu mặc định (admin, bảng giá điện)."""
     initialize_database()
+
+# Mặc định vẫn khởi tạo khi import (chạy local: python flask_app.py).
+# Procfile đặt SKIP_DB_INIT=1 cho cả bước release (init-db tự chạy initialize_database, không chạy 2 lần)
+# lẫn tiến trình web (khởi động không cần create_all / migration / kiểm tra seed)
+if not os.environ.get('SKIP_DB_INIT'):
+    with app.app_context():
+        initialize_database()
+        # Đóng các kết nối đã mở lúc khởi tạo: khi chạy gunicorn --preload, đoạn này chỉ chạy 1 lần
+        # ở tiến trình master, các worker fork ra phải tự mở kết nối riêng (không dùng chung socket)
+        db.session.remove()
+        db.engine.dispose()
 # ======================================================================
 
 # Routes
@@ -255,7 +549,7 @@ def login():
         username = request.form['username']
         password = request.form['password']
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
+        if user and verify_password(user, password):
             login_user(user)
             return redirect(url_for('dashboard'))
         flash('Tên đăng nhập hoặc mật khẩu không đúng', 'danger')
@@ -269,17 +563,10 @@ def logout():
 
 @app.route('/register', methods=['GET', 'POST'])
 @login_required
+@admin_required('Chỉ admin mới được tạo người dùng')
 def register():
-    if current_user.role != 'admin':
-        flash('Chỉ admin mới được tạo người dùng', 'danger')
-        return redirect(url_for('dashboard'))
-    
-    # Lấy danh sách tất cả khách thuê để gán (nếu role tenant)
-    tenants = Tenant.query.all()
-    
-    # Join room cho mỗi tenant để hiển thị tên phòng
-    for tenant in tenants:
-        tenant.room = Room.query.get(tenant.room_id)
+    # Lấy danh sách tất cả khách thuê để gán (nếu role tenant), JOIN sẵn phòng để hiển thị tên phòng
+    tenants = Tenant.query.options(joinedload(Tenant.room)).all()
     
     if request.method == 'POST':
         username = request.form['username'].strip()
@@ -287,7 +574,7 @@ def register():
         role = request.form['role']
         
         # Kiểm tra username trùng
-        if User.query.filter_by(username=username).first():
+        if row_exists(User.username == username):
             flash('Tên đăng nhập đã tồn tại', 'danger')
             return render_template('register.html', tenants=tenants)
         
@@ -297,7 +584,7 @@ def register():
         
         new_user = User(
             username=username,
-            password=generate_password_hash(password, method='pbkdf2:sha256'),
+            password=generate_password_hash(password, method=PASSWORD_HASH_METHOD),
             role=role
         )
         
@@ -332,14 +619,14 @@ def signup():
             return render_template('signup.html')
         
         # Kiểm tra username trùng
-        if User.query.filter_by(username=username).first():
+        if row_exists(User.username == username):
             flash('Tên đăng nhập đã tồn tại. Vui lòng chọn tên khác.', 'danger')
             return render_template('signup.html')
         
         # Tạo user mới với role = 'user' (chủ trọ bình thường)
         new_user = User(
             username=username,
-            password=generate_password_hash(password, method='pbkdf2:sha256'),
+            password=generate_password_hash(password, method=PASSWORD_HASH_METHOD),
             role='user'  # Mọi người tự đăng ký đều là chủ trọ thường
         )
         db.session.add(new_user)
@@ -358,32 +645,36 @@ def signup():
 
 @app.route('/manage_users')
 @login_required
+@admin_required()
 def manage_users():
-    if current_user.role != 'admin':
-        flash('Chỉ admin mới được truy cập', 'danger')
-        return redirect(url_for('dashboard'))
+    # Chỉ khách thuê / phòng đang gắn với tài khoản mới hiển thị tên trên trang này
+    linked_tenant_ids = db.select(User.tenant_id).where(User.tenant_id.isnot(None))
+    etag = make_etag(*data_version(
+        User,
+        (Tenant, Tenant.id.in_(linked_tenant_ids)),
+        (Room, Room.id.in_(db.select(Tenant.room_id).where(Tenant.id.in_(linked_tenant_ids))))
+    ))
+    cached = not_modified(etag)
+    if cached:
+        return cached
     
-    users = User.query.all()
+    # Chỉ lấy các cột trang cần (không nạp hash mật khẩu), kèm tên khách thuê + phòng bằng OUTER JOIN
+    users = db.session.execute(
+        db.select(
+            User.id, User.username, User.role,
+            Tenant.name.label('tenant_name'), Room.name.label('room_name')
+        ).outerjoin(User.tenant).outerjoin(Tenant.room).order_by(User.id)
+    ).all()
     
-    # Join tenant_linked cho user role tenant
-    for user in users:
-        if user.role == 'tenant' and user.tenant_id:
-            user.tenant_linked = Tenant.query.get(user.tenant_id)
-            if user.tenant_linked:
-                user.tenant_linked.room = Room.query.get(user.tenant_linked.room_id)
+    total_admins = get_admin_count()
     
-    total_admins = User.query.filter_by(role='admin').count()
-    
-    return render_template('manage_users.html', users=users, total_admins=total_admins)
+    return with_etag(render_template('manage_users.html', users=users, total_admins=total_admins), etag)
     
 @app.route('/edit_user/<int:user_id>', methods=['GET', 'POST'])
 @login_required
+@admin_required('Chỉ admin mới được chỉnh sửa')
 def edit_user(user_id):
-    if current_user.role != 'admin':
-        flash('Chỉ admin mới được chỉnh sửa', 'danger')
-        return redirect(url_for('dashboard'))
-    
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
@@ -392,8 +683,7 @@ def edit_user(user_id):
         
         # Kiểm tra username không trùng với user khác
         if username and username != user.username:
-            existing = User.query.filter_by(username=username).first()
-            if existing:
+            if row_exists(User.username == username):
                 flash('Tên đăng nhập đã được sử dụng', 'danger')
                 return render_template('edit_users.html', user=user)
         
@@ -401,7 +691,7 @@ def edit_user(user_id):
         
         # Chỉ cập nhật password nếu người dùng nhập mới
         if password:
-            user.password = generate_password_hash(password, method='pbkdf2:sha256')
+            user.password = generate_password_hash(password, method=PASSWORD_HASH_METHOD)
         
         # Chỉ admin mới được thay đổi role của chính mình
         if role and role in ['admin', 'user', 'tenant']:
@@ -418,18 +708,21 @@ def edit_user(user_id):
 
 @app.route('/delete_user/<int:user_id>', methods=['POST'])
 @login_required
+@admin_required('Chỉ admin mới được xóa')
 def delete_user(user_id):
-    if current_user.role != 'admin':
-        flash('Chỉ admin mới được xóa', 'danger')
-        return redirect(url_for('dashboard'))
-    
-    user = User.query.get_or_404(user_id)
+    user = db.get_or_404(User, user_id)
     if user.id == current_user.id:
         flash('Không thể xóa chính tài khoản đang đăng nhập', 'danger')
         return redirect(url_for('manage_users'))
-    if user.role == 'admin' and User.query.filter_by(role='admin').count() == 1:
-        flash('Không thể xóa admin cuối cùng', 'danger')
-        return redirect(url_for('manage_users'))
+    # Khóa các dòng admin (theo thứ tự id, tránh deadlock) đến khi commit: 2 request xóa 2 admin
+    # cuối cùng cùng lúc không thể cùng thấy "còn admin khác". Index ix_user_role → chỉ đọc vài dòng admin
+    if user.role == 'admin':
+        admin_ids = db.session.scalars(
+            db.select(User.id).where(User.role == 'admin').order_by(User.id).with_for_update()
+        ).all()
+        if admin_ids == [user.id]:
+            flash('Không thể xóa admin cuối cùng', 'danger')
+            return redirect(url_for('manage_users'))
     
     db.session.delete(user)
     db.session.commit()
@@ -439,63 +732,79 @@ def delete_user(user_id):
 @app.route('/')
 @login_required
 def dashboard():
-    rooms = Room.query.filter_by(user_id=current_user.id).all() if current_user.role != 'admin' else Room.query.all()
-
-    # Gắn tenant đang hoạt động vào mỗi phòng để hiển thị trong danh sách
     today = datetime.now().date()
-    current_month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-
-    for room in rooms:
-        active_tenant = Tenant.query.join(Contract).filter(
-            Tenant.room_id == room.id,
-            Contract.end_date >= today
-        ).first()
-        if not active_tenant:
-            active_tenant = Tenant.query.filter_by(room_id=room.id).order_by(Tenant.id.desc()).first()
-        room.tenant = active_tenant
-
-    # Tính các chỉ số tổng quan
-    total_rooms = len(rooms)
-    occupied_rooms = 0
-    total_due = 0
-    total_paid = 0
-    overdue_bills = 0
-
-    for room in rooms:
-        # Chỉ tính phòng có hợp đồng còn hiệu lực
-        active_contract = Contract.query.join(Tenant).filter(
-            Tenant.room_id == room.id,
-            Contract.end_date >= today
-        ).first()
-
-    for room in rooms:
-        # Chỉ tính phòng có hợp đồng còn hiệu lực
-        active_contract = Contract.query.join(Tenant).filter(
-            Tenant.room_id == room.id,
-            Contract.end_date >= today
-        ).first()
-
-        if active_contract:
-            occupied_rooms += 1
-            # Lấy bills trong 2 tháng gần nhất để không bỏ sót bill tháng trước chưa thanh toán
-            two_months_ago = (current_month_start - timedelta(days=32)).replace(day=1)
-            bills = Bill.query.filter(
-                Bill.contract_id == active_contract.id,
-                Bill.month >= two_months_ago
-            ).all()
-            for bill in bills:
-                total_due += bill.total
-                if bill.paid:
-                    total_paid += bill.total
-                # Quá hạn: chưa thanh toán và đã qua ngày 5 tháng sau
-                if not bill.paid:
-                    due_date = (bill.month + timedelta(days=32)).replace(day=5)
-                    if today > due_date:
-                        overdue_bills += 1
+    # Chủ trọ: chỉ phòng của mình và khách thuê / hợp đồng / bill thuộc các phòng đó
+    if current_user.role == 'admin':
+        scopes = (Room, Tenant, Contract, Bill)
+    else:
+        own_room_ids = db.select(Room.id).where(Room.user_id == current_user.id)
+        own_tenant_ids = db.select(Tenant.id).where(Tenant.room_id.in_(own_room_ids))
+        own_contract_ids = db.select(Contract.id).where(Contract.tenant_id.in_(own_tenant_ids))
+        scopes = (
+            (Room, Room.user_id == current_user.id),
+            (Tenant, Tenant.room_id.in_(own_room_ids)),
+            (Contract, Contract.tenant_id.in_(own_tenant_ids)),
+            (Bill, Bill.contract_id.in_(own_contract_ids)),
+        )
+    etag = make_etag(today, *data_version(*scopes))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    # Chỉ lấy các cột hiển thị trên thẻ phòng, không dựng object ORM
+    rooms_query = db.select(Room.id, Room.name, Room.rent_price, Room.internet_fee)
+    if current_user.role != 'admin':
+        rooms_query = rooms_query.where(Room.user_id == current_user.id)
+    rooms = db.session.execute(rooms_query.order_by(Room.id)).all()
+    room_ids = [room.id for room in rooms]
+
+    current_month_start = today.replace(day=1)
+    # Lấy bills trong 2 tháng gần nhất để không bỏ sót bill tháng trước chưa thanh toán
+    two_months_ago = (current_month_start - timedelta(days=32)).replace(day=1)
+
+    # Gắn tenant đang hoạt động vào mỗi phòng để hiển thị trong danh sách (1 truy vấn cho tất cả phòng):
+    # ROW_NUMBER theo từng phòng, ưu tiên khách có hợp đồng còn hiệu lực,
+    # không có thì lấy khách thuê mới nhất (id lớn nhất) của phòng
+    ranked_tenants = db.select(
+        Tenant.id,
+        func.row_number().over(
+            partition_by=Tenant.room_id,
+            order_by=[case((Contract.id.isnot(None), 0), else_=1), Tenant.id.desc()]
+        ).label('rn')
+    ).outerjoin(
+        Contract, and_(Contract.tenant_id == Tenant.id, Contract.end_date >= today)
+    ).where(Tenant.room_id.in_(room_ids)).subquery()
+    room_tenants = dict(db.session.execute(
+        db.select(Tenant.room_id, Tenant.name).join(
+            ranked_tenants, and_(Tenant.id == ranked_tenants.c.id, ranked_tenants.c.rn == 1)
+        )
+    ).all())
+
+    rooms = [dict(room._mapping, tenant_name=room_tenants.get(room.id)) for room in rooms]
+
+    # 1 truy vấn SQL duy nhất cho: số phòng đang cho thuê (phòng có hợp đồng còn hiệu lực),
+    # tổng tiền / đã thu / số bill quá hạn của các hợp đồng đó
+    # OUTER JOIN Bill để phòng có hợp đồng nhưng chưa có bill vẫn được đếm
+    totals_query = db.select(
+        func.count(func.distinct(Room.id)),
+        func.coalesce(func.sum(Bill.total), 0),
+        func.coalesce(func.sum(case((Bill.paid.is_(True), Bill.total), else_=0)), 0),
+        func.count(case((and_(Bill.paid.isnot(True), Bill.month < overdue_cutoff(today)), 1)))
+    ).select_from(Room).join(
+        Tenant, Tenant.room_id == Room.id
+    ).join(
+        Contract, and_(Contract.tenant_id == Tenant.id, Contract.end_date >= today)
+    ).outerjoin(
+        Bill, and_(Bill.contract_id == Contract.id, Bill.month >= two_months_ago)
+    )
+    if current_user.role != 'admin':
+        totals_query = totals_query.where(Room.user_id == current_user.id)
+    occupied_rooms, total_due, total_paid, overdue_bills = db.session.execute(totals_query).one()
 
+    total_rooms = len(rooms)
     total_unpaid = total_due - total_paid
 
-    return render_template(
+    return with_etag(render_template(
         'dashboard.html',
         rooms=rooms,
         total_rooms=total_rooms,
@@ -504,7 +813,7 @@ def dashboard():
         total_paid=total_paid,
         total_unpaid=total_unpaid,
         overdue_bills=overdue_bills
-    )
+    ), etag)
 
 @app.route('/create_room', methods=['GET', 'POST'])
 @login_required
@@ -523,18 +832,22 @@ def create_room():
 @app.route('/room/<int:room_id>')
 @login_required
 def room_detail(room_id):
-    room = Room.query.get_or_404(room_id)
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    room = db.get_or_404(Room, room_id)
+    if not can_manage_room(room):
         flash('Access denied')
         return redirect(url_for('dashboard'))
+    etag = make_etag(room_id, room.updated_at, *data_version((Tenant, Tenant.room_id == room_id)))
+    cached = not_modified(etag)
+    if cached:
+        return cached
     tenants = Tenant.query.filter_by(room_id=room_id).all()
-    return render_template('room_detail.html', room=room, tenants=tenants)
+    return with_etag(render_template('room_detail.html', room=room, tenants=tenants), etag)
 
 @app.route('/edit_room/<int:room_id>', methods=['GET', 'POST'])
 @login_required
 def edit_room(room_id):
-    room = Room.query.get_or_404(room_id)
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    room = db.get_or_404(Room, room_id)
+    if not can_manage_room(room):
         flash('Bạn không có quyền', 'danger')
         return redirect(url_for('dashboard'))
     
@@ -551,13 +864,13 @@ def edit_room(room_id):
 @app.route('/delete_room/<int:room_id>', methods=['POST'])
 @login_required
 def delete_room(room_id):
-    room = Room.query.get_or_404(room_id)
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    room = db.get_or_404(Room, room_id)
+    if not can_manage_room(room):
         flash('Bạn không có quyền', 'danger')
         return redirect(url_for('dashboard'))
     
     # Kiểm tra phòng có khách thuê chưa
-    if Tenant.query.filter_by(room_id=room_id).first():
+    if row_exists(Tenant.room_id == room_id):
         flash('Không thể xóa phòng đang có khách thuê!', 'danger')
         return redirect(url_for('room_detail', room_id=room_id))
     
@@ -569,8 +882,8 @@ def delete_room(room_id):
 @app.route('/create_tenant/<int:room_id>', methods=['GET', 'POST'])
 @login_required
 def create_tenant(room_id):
-    room = Room.query.get_or_404(room_id)
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    room = db.get_or_404(Room, room_id)
+    if not can_manage_room(room):
         flash('Access denied')
         return redirect(url_for('dashboard'))
     if request.method == 'POST':
@@ -587,15 +900,15 @@ def create_tenant(room_id):
 @app.route('/create_contract/<int:tenant_id>', methods=['GET', 'POST'])
 @login_required
 def create_contract(tenant_id):
-    tenant = Tenant.query.get_or_404(tenant_id)
-    room = Room.query.get(tenant.room_id)
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    tenant = get_tenant_or_404(tenant_id)
+    room = tenant.room
+    if not can_manage_room(room):
         flash('Access denied')
         return redirect(url_for('dashboard'))
     if request.method == 'POST':
-        start_date = datetime.strptime(request.form['start_date'], '%Y-%m-%d').date()
+        start_date = date.fromisoformat(request.form['start_date'])
         duration_months = int(request.form['duration_months'])
-        end_date = start_date + timedelta(days=30 * duration_months)  # Approximate
+        end_date = add_months(start_date, duration_months)
         new_contract = Contract(tenant_id=tenant_id, start_date=start_date, duration_months=duration_months, end_date=end_date)
         db.session.add(new_contract)
         db.session.commit()
@@ -606,26 +919,31 @@ def create_contract(tenant_id):
 @app.route('/tenant/<int:tenant_id>')
 @login_required
 def tenant_detail(tenant_id):
-    tenant = Tenant.query.get_or_404(tenant_id)
-    room = Room.query.get(tenant.room_id)
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    tenant = get_tenant_or_404(tenant_id)
+    room = tenant.room
+    if not can_manage_room(room):
         flash('Access denied')
         return redirect(url_for('dashboard'))
+    etag = make_etag(tenant_id, tenant.updated_at, *data_version((Contract, Contract.tenant_id == tenant_id)))
+    cached = not_modified(etag)
+    if cached:
+        return cached
     contracts = Contract.query.filter_by(tenant_id=tenant_id).all()
-    return render_template('tenant_detail.html', tenant=tenant, contracts=contracts)
+    return with_etag(render_template('tenant_detail.html', tenant=tenant, contracts=contracts), etag)
 
 @app.route('/extend_contract/<int:contract_id>', methods=['POST'])
 @login_required
 def extend_contract(contract_id):
-    contract = Contract.query.get_or_404(contract_id)
-    tenant = Tenant.query.get(contract.tenant_id)
-    room = Room.query.get(tenant.room_id)
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    contract = get_contract_or_404(contract_id)
+    tenant = contract.tenant
+    room = tenant.room
+    if not can_manage_room(room):
         flash('Access denied')
         return redirect(url_for('dashboard'))
     additional_months = int(request.form['additional_months'])
     contract.duration_months += additional_months
-    contract.end_date += timedelta(days=30 * additional_months)
+    # Tính lại từ ngày bắt đầu (không cộng dồn vào end_date cũ) để không lệch ngày khi gia hạn nhiều lần
+    contract.end_date = add_months(contract.start_date, contract.duration_months)
     contract.is_extended = True
     db.session.commit()
     flash('Contract extended')
@@ -634,64 +952,42 @@ def extend_contract(contract_id):
 @app.route('/contract/<int:contract_id>')
 @login_required
 def contract_detail(contract_id):
-    contract = Contract.query.get_or_404(contract_id)
-    tenant = Tenant.query.get(contract.tenant_id)
+    contract = get_contract_or_404(contract_id, joinedload(Contract.bills))
+    tenant = contract.tenant
     if tenant is None:
         flash('Khách thuê liên kết với hợp đồng không tồn tại. Vui lòng kiểm tra dữ liệu.', 'danger')
         return redirect(url_for('dashboard'))
-    room = Room.query.get(tenant.room_id)
+    room = tenant.room
     if room is None:
         flash('Phòng liên kết không tồn tại. Vui lòng kiểm tra dữ liệu.', 'danger')
         return redirect(url_for('dashboard'))
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    if not can_manage_room(room):
         flash('Bạn không có quyền truy cập hợp đồng này', 'danger')
         return redirect(url_for('dashboard'))
-    bills = Bill.query.filter_by(contract_id=contract_id).all()
+    bills = contract.bills
     return render_template('contract_detail.html', contract=contract, tenant=tenant, bills=bills)
 
 @app.route('/create_bill/<int:contract_id>', methods=['GET', 'POST'])
 @login_required
 def create_bill(contract_id):
-    contract = Contract.query.get_or_404(contract_id)
-    tenant = Tenant.query.get(contract.tenant_id)
-    room = Room.query.get(tenant.room_id)
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    contract = get_contract_or_404(contract_id)
+    tenant = contract.tenant
+    room = tenant.room
+    if not can_manage_room(room):
         flash('Bạn không có quyền', 'danger')
         return redirect(url_for('dashboard'))
     
-    last_bill = Bill.query.filter_by(contract_id=contract_id).order_by(Bill.month.desc()).first()
-    
-    # Tính đơn giá trung bình dự kiến để hiển thị trên form
-    # Ưu tiên dùng tháng từ query string (?month=YYYY-MM), fallback về tháng hiện tại
-    month_param = request.args.get('month', '')
-    try:
-        preview_month = datetime.strptime(month_param + '-01', '%Y-%m-%d').replace(day=1)
-    except (ValueError, TypeError):
-        preview_month = datetime.now().replace(day=1)
-    
-    total_kwh_preview = get_total_electricity_usage_in_month(preview_month)
-    total_cost_preview = calculate_total_electricity_cost_before_vat(total_kwh_preview)
-
-    # Ưu tiên lấy đơn giá từ TotalElectricityMonth nếu admin đã nhập tổng điện tháng đó
-    total_elec_entry = TotalElectricityMonth.query.filter(
-        TotalElectricityMonth.month == preview_month.date() if hasattr(preview_month, 'date') else preview_month
-    ).first()
-    if total_elec_entry and total_elec_entry.average_price > 0:
-        average_price_preview = total_elec_entry.average_price
-    else:
-        average_price_preview = total_cost_preview / total_kwh_preview if total_kwh_preview > 0 else 0
-    
     if request.method == 'POST':
         try:
             month_str = request.form['month'] + '-01'
-            month = datetime.strptime(month_str, '%Y-%m-%d').date()
+            month = date.fromisoformat(month_str)
             
             electricity_old = float(request.form.get('electricity_old', 0))
             electricity_new = float(request.form.get('electricity_new', 0))
             water_old = float(request.form.get('water_old', 0))
             water_new = float(request.form.get('water_new', 0))
             
-            bill_data = calculate_bill(contract, electricity_old, electricity_new, water_old, water_new, month)
+            bill_data = calculate_bill(room, electricity_old, electricity_new, water_old, water_new, month)
             
             new_bill = Bill(
                 contract_id=contract_id,
@@ -714,12 +1010,30 @@ def create_bill(contract_id):
             db.session.commit()
             flash('Hóa đơn đã được tạo thành công!', 'success')
             return redirect(url_for('contract_detail', contract_id=contract_id))
+        except IntegrityError:
+            db.session.rollback()
+            flash('Hợp đồng này đã có hóa đơn cho tháng đã chọn.', 'danger')
+            return redirect(url_for('create_bill', contract_id=contract_id))
         except Exception as e:
             db.session.rollback()
             flash(f'Lỗi khi tạo hóa đơn: {str(e)}. Vui lòng kiểm tra lại chỉ số hoặc thử lại.', 'danger')
             return redirect(url_for('create_bill', contract_id=contract_id))
     
-    # GET: return render_template với average_price_preview
+    # GET: Tính đơn giá trung bình dự kiến để hiển thị trên form
+    # Ưu tiên dùng tháng từ query string (?month=YYYY-MM), fallback về tháng hiện tại
+    month_param = request.args.get('month', '')
+    try:
+        preview_month = date.fromisoformat(month_param + '-01')
+    except (ValueError, TypeError):
+        preview_month = date.today().replace(day=1)
+
+    # Đọc đơn giá đã tính sẵn trong TotalElectricityMonth (admin đã nhập tổng điện tháng đó),
+    # chỉ tính lại theo bậc thang khi tháng đó chưa có
+    average_price_preview = get_average_price(preview_month)
+
+    # Bill gần nhất để điền sẵn chỉ số cũ trên form
+    last_bill = Bill.query.filter_by(contract_id=contract_id).order_by(Bill.month.desc()).first()
+
     return render_template(
         'create_bill.html',
         contract=contract,
@@ -731,14 +1045,86 @@ def create_bill(contract_id):
         average_price_preview=round(average_price_preview)
     )
     
+@app.route('/generate_bills', methods=['POST'])
+@login_required
+def generate_bills():
+    try:
+        month = date.fromisoformat(request.form['month'] + '-01')
+    except (KeyError, ValueError):
+        flash('Tháng không hợp lệ', 'danger')
+        return redirect(url_for('dashboard'))
+    next_month = (month + timedelta(days=32)).replace(day=1)
+
+    # Hợp đồng còn hiệu lực trong tháng và chưa có hóa đơn tháng đó (kèm khách thuê + phòng)
+    contracts_query = Contract.query.join(Contract.tenant).join(Tenant.room).options(
+        contains_eager(Contract.tenant).contains_eager(Tenant.room)
+    ).filter(
+        Contract.start_date < next_month,
+        Contract.end_date >= month,
+        ~exists().where(and_(Bill.contract_id == Contract.id, Bill.month == month))
+    )
+    if current_user.role != 'admin':
+        contracts_query = contracts_query.filter(Room.user_id == current_user.id)
+    contracts = contracts_query.all()
+
+    if not contracts:
+        flash('Không có hợp đồng nào cần tạo hóa đơn cho tháng này', 'info')
+        return redirect(url_for('dashboard'))
+
+    # Hóa đơn gần nhất của mỗi hợp đồng (1 truy vấn) để lấy chỉ số cũ
+    last_months = db.select(
+        Bill.contract_id, func.max(Bill.month).label('month')
+    ).where(
+        Bill.contract_id.in_([contract.id for contract in contracts])
+    ).group_by(Bill.contract_id).subquery()
+    last_bills = {
+        bill.contract_id: bill for bill in Bill.query.join(
+            last_months,
+            and_(Bill.contract_id == last_months.c.contract_id, Bill.month == last_months.c.month)
+        )
+    }
+
+    # Mọi phòng trong tháng dùng chung 1 đơn giá trung bình → chỉ tính 1 lần
+    average_price = get_average_price(month)
+
+    # Chỉ số mới = chỉ số cũ, chủ trọ sửa lại từng hóa đơn khi chốt số điện nước
+    # Tính toàn bộ dòng trong bộ nhớ rồi insert 1 lượt (dict, không dựng object ORM)
+    rows = []
+    for contract in contracts:
+        last_bill = last_bills.get(contract.id)
+        electricity = last_bill.electricity_new if last_bill else 0.0
+        water = last_bill.water_new if last_bill else 0.0
+        bill_data = calculate_bill(contract.tenant.room, electricity, electricity, water, water, month, average_price)
+        rows.append(dict(
+            contract_id=contract.id,
+            month=month,
+            electricity_old=electricity,
+            electricity_new=electricity,
+            water_old=water,
+            water_new=water,
+            paid=False,
+            **bill_data
+        ))
+
+    try:
+        db.session.bulk_insert_mappings(Bill, rows)
+        db.session.commit()
+    except IntegrityError:
+        # Gửi form 2 lần / 2 người cùng tạo: request kia đã tạo bill tháng này trước (uq_bill_contract_month)
+        db.session.rollback()
+        flash('Hóa đơn tháng này vừa được tạo bởi một yêu cầu khác. Vui lòng kiểm tra lại danh sách hóa đơn.', 'warning')
+        return redirect(url_for('dashboard'))
+    flash(f'Đã tạo {len(rows)} hóa đơn tháng {month.strftime("%m/%Y")}. Vui lòng cập nhật chỉ số điện nước mới.', 'success')
+    return redirect(url_for('dashboard'))
+
 @app.route('/pay_bill/<int:bill_id>', methods=['POST'])
 @login_required
 def pay_bill(bill_id):
-    bill = Bill.query.get_or_404(bill_id)
-    contract = Contract.query.get(bill.contract_id)
-    tenant = Tenant.query.get(contract.tenant_id)
-    room = Room.query.get(tenant.room_id)
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    bill = get_bill_or_404(bill_id)
+    contract = bill.contract
+    tenant = contract.tenant
+    room = tenant.room
+    if not can_manage_room(room):
         flash('Access denied')
         return redirect(url_for('dashboard'))
     bill.paid = True
@@ -749,46 +1135,54 @@ def pay_bill(bill_id):
 @app.route('/bill_print/<int:bill_id>')
 @login_required
 def bill_print(bill_id):
-    bill = Bill.query.get_or_404(bill_id)
-    contract = Contract.query.get(bill.contract_id)
-    tenant = Tenant.query.get(contract.tenant_id)
+    bill = get_bill_or_404(bill_id)
+    contract = bill.contract
+    tenant = contract.tenant
     if tenant is None:
         flash('Khách thuê không tồn tại', 'danger')
         return redirect(url_for('dashboard'))
-    room = Room.query.get(tenant.room_id)
+    room = tenant.room
     if room is None:
         flash('Phòng không tồn tại', 'danger')
         return redirect(url_for('dashboard'))
 
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    if not can_manage_room(room):
         flash('Bạn không có quyền xem hóa đơn này', 'danger')
         return redirect(url_for('dashboard'))
 
-    return render_template('bill_print.html',
-                           bill=bill,
-                           tenant=tenant,
-                           room=room,
-                           datetime=datetime)
+    # Hóa đơn, khách thuê, phòng đã nạp sẵn bằng JOIN → ETag không cần thêm truy vấn.
+    # Kèm phút hiện tại vì trang in hiển thị "Ngày in" đến phút
+    printed_at = datetime.now().strftime('%d/%m/%Y %H:%M')
+    etag = make_etag(bill.id, bill.updated_at, tenant.updated_at, room.updated_at, printed_at)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    return with_etag(render_template('bill_print.html',
+                                     bill=bill,
+                                     tenant=tenant,
+                                     room=room,
+                                     datetime=datetime), etag)
 
 # --- Sửa hợp đồng ---
 @app.route('/edit_contract/<int:contract_id>', methods=['GET', 'POST'])
 @login_required
 def edit_contract(contract_id):
-    contract = Contract.query.get_or_404(contract_id)
-    tenant = Tenant.query.get(contract.tenant_id)
-    room = Room.query.get(tenant.room_id)
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    contract = get_contract_or_404(contract_id)
+    tenant = contract.tenant
+    room = tenant.room
+    if not can_manage_room(room):
         flash('Bạn không có quyền chỉnh sửa hợp đồng này', 'danger')
         return redirect(url_for('dashboard'))
 
-    if Bill.query.filter_by(contract_id=contract_id).first():
+    if row_exists(Bill.contract_id == contract_id):
         flash('Không thể sửa hợp đồng đã có hóa đơn', 'danger')
         return redirect(url_for('contract_detail', contract_id=contract_id))
 
     if request.method == 'POST':
-        contract.start_date = datetime.strptime(request.form['start_date'], '%Y-%m-%d').date()
+        contract.start_date = date.fromisoformat(request.form['start_date'])
         contract.duration_months = int(request.form['duration_months'])
-        contract.end_date = contract.start_date + timedelta(days=30 * contract.duration_months)  # xấp xỉ
+        contract.end_date = add_months(contract.start_date, contract.duration_months)
         db.session.commit()
         flash('Hợp đồng đã được cập nhật thành công!', 'success')
         return redirect(url_for('contract_detail', contract_id=contract_id))
@@ -799,14 +1193,15 @@ def edit_contract(contract_id):
 @app.route('/delete_contract/<int:contract_id>', methods=['POST'])
 @login_required
 def delete_contract(contract_id):
-    contract = Contract.query.get_or_404(contract_id)
-    tenant = Tenant.query.get(contract.tenant_id)
-    room = Room.query.get(tenant.room_id)
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    # bills để lazy: SQLAlchemy cần nạp collection này khi xóa hợp đồng
+    contract = get_contract_or_404(contract_id, lazyload(Contract.bills))
+    tenant = contract.tenant
+    room = tenant.room
+    if not can_manage_room(room):
         flash('Bạn không có quyền', 'danger')
         return redirect(url_for('dashboard'))
 
-    if Bill.query.filter_by(contract_id=contract_id).first():
+    if row_exists(Bill.contract_id == contract_id):
         flash('Không thể xóa hợp đồng đã có hóa đơn', 'danger')
         return redirect(url_for('contract_detail', contract_id=contract_id))
 
@@ -819,18 +1214,18 @@ def delete_contract(contract_id):
 @app.route('/edit_bill/<int:bill_id>', methods=['GET', 'POST'])
 @login_required
 def edit_bill(bill_id):
-    bill = Bill.query.get_or_404(bill_id)
-    contract = Contract.query.get(bill.contract_id)
-    tenant = Tenant.query.get(contract.tenant_id)
-    room = Room.query.get(tenant.room_id)
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    bill = get_bill_or_404(bill_id)
+    contract = bill.contract
+    tenant = contract.tenant
+    room = tenant.room
+    if not can_manage_room(room):
         flash('Bạn không có quyền', 'danger')
         return redirect(url_for('dashboard'))
     
     if request.method == 'POST':
         try:
             month_str = request.form['month'] + '-01'
-            month = datetime.strptime(month_str, '%Y-%m-%d').date()
+            month = date.fromisoformat(month_str)
 
             electricity_old = float(request.form['electricity_old'])
             electricity_new = float(request.form['electricity_new'])
@@ -838,7 +1233,7 @@ def edit_bill(bill_id):
             water_new = float(request.form['water_new'])
 
             # Tính lại toàn bộ theo bài toán mới
-            bill_data = calculate_bill(contract, electricity_old, electricity_new, water_old, water_new, month)
+            bill_data = calculate_bill(room, electricity_old, electricity_new, water_old, water_new, month)
 
             # Cập nhật bill
             bill.month = month
@@ -858,6 +1253,10 @@ def edit_bill(bill_id):
             db.session.commit()
             flash('Hóa đơn đã được cập nhật thành công!', 'success')
             return redirect(url_for('contract_detail', contract_id=contract.id))
+        except IntegrityError:
+            db.session.rollback()
+            flash('Hợp đồng này đã có hóa đơn cho tháng đã chọn.', 'danger')
+            return redirect(url_for('edit_bill', bill_id=bill_id))
         except Exception as e:
             db.session.rollback()
             flash(f'Lỗi khi cập nhật hóa đơn: {str(e)}', 'danger')
@@ -871,11 +1270,11 @@ def edit_bill(bill_id):
 @app.route('/delete_bill/<int:bill_id>', methods=['POST'])
 @login_required
 def delete_bill(bill_id):
-    bill = Bill.query.get_or_404(bill_id)
-    contract = Contract.query.get(bill.contract_id)
-    tenant = Tenant.query.get(contract.tenant_id)
-    room = Room.query.get(tenant.room_id)
-    if current_user.role != 'admin' and room.user_id != current_user.id:
+    bill = get_bill_or_404(bill_id)
+    contract = bill.contract
+    tenant = contract.tenant
+    room = tenant.room
+    if not can_manage_room(room):
         flash('Bạn không có quyền', 'danger')
         return redirect(url_for('dashboard'))
 
@@ -886,23 +1285,12 @@ def delete_bill(bill_id):
 
 @app.route('/manage_total_electricity', methods=['GET', 'POST'])
 @login_required
+@admin_required()
 def manage_total_electricity():
-    if current_user.role != 'admin':
-        flash('Chỉ admin mới được truy cập', 'danger')
-        return redirect(url_for('dashboard'))
-    
-    months = []
-    try:
-        months = TotalElectricityMonth.query.order_by(TotalElectricityMonth.month.desc()).all()
-    except Exception as e:
-        db.session.rollback()
-        flash('Kết nối database tạm gián đoạn. Vui lòng thử lại.', 'warning')
-        db.session.close()
-    
     if request.method == 'POST':
         try:
             month_str = request.form['month'] + '-01'
-            month = datetime.strptime(month_str, '%Y-%m-%d').date()
+            month = date.fromisoformat(month_str)
             electricity_old = float(request.form['electricity_old'])
             electricity_new = float(request.form['electricity_new'])
             
@@ -915,6 +1303,7 @@ def manage_total_electricity():
                 electricity_old=electricity_old,
                 electricity_new=electricity_new,
                 total_kwh=total_kwh,
+                total_cost_before_vat=total_cost_before_vat,
                 average_price=average_price
             )
             db.session.add(entry)
@@ -924,22 +1313,42 @@ def manage_total_electricity():
         except Exception as e:
             db.session.rollback()
             flash(f'Lỗi khi lưu: {str(e)}. Vui lòng thử lại.', 'danger')
+
+    # Danh sách chỉ nạp khi render (POST thành công đã redirect), lấy đúng các cột hiển thị
+    months = []
+    try:
+        months = db.session.execute(
+            db.select(
+                TotalElectricityMonth.id, TotalElectricityMonth.month,
+                TotalElectricityMonth.electricity_old, TotalElectricityMonth.electricity_new,
+                TotalElectricityMonth.total_kwh, TotalElectricityMonth.total_cost_before_vat,
+                TotalElectricityMonth.average_price
+            ).order_by(TotalElectricityMonth.month.desc())
+        ).all()
+    except Exception as e:
+        db.session.rollback()
+        flash('Kết nối database tạm gián đoạn. Vui lòng thử lại.', 'warning')
+        db.session.close()
     
     return render_template('manage_total_electricity.html', months=months)
 
 @app.route('/edit_total_electricity/<int:entry_id>', methods=['POST'])
 @login_required
+@admin_required()
 def edit_total_electricity(entry_id):
-    if current_user.role != 'admin':
-        flash('Chỉ admin mới được truy cập', 'danger')
-        return redirect(url_for('dashboard'))
-    
-    entry = TotalElectricityMonth.query.get_or_404(entry_id)
+    entry = db.get_or_404(TotalElectricityMonth, entry_id)
     
-    month_str = request.form['month'] + '-01'
-    month = datetime.strptime(month_str, '%Y-%m-%d').date()
-    electricity_old = float(request.form['electricity_old'])
-    electricity_new = float(request.form['electricity_new'])
+    try:
+        month_str = request.form['month'] + '-01'
+        month = date.fromisoformat(month_str)
+        electricity_old = float(request.form['electricity_old'])
+        electricity_new = float(request.form['electricity_new'])
+    except (KeyError, ValueError):
+        message = 'Tháng hoặc chỉ số điện không hợp lệ'
+        if is_htmx():
+            return htmx_response('', message, 'danger', swap=False)
+        flash(message, 'danger')
+        return redirect(url_for('manage_total_electricity'))
     
     total_kwh = max(electricity_new - electricity_old, 0)
     total_cost_before_vat = calculate_total_electricity_cost_before_vat(total_kwh)
@@ -949,56 +1358,92 @@ def edit_total_electricity(entry_id):
     entry.electricity_old = electricity_old
     entry.electricity_new = electricity_new
     entry.total_kwh = total_kwh
+    entry.total_cost_before_vat = total_cost_before_vat
     entry.average_price = average_price
     
-    db.session.commit()
-    flash('Tổng điện tháng đã được cập nhật thành công!', 'success')
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        message = f'Lỗi khi lưu: {str(e)}. Vui lòng thử lại.'
+        if is_htmx():
+            return htmx_response('', message, 'danger', swap=False)
+        flash(message, 'danger')
+        return redirect(url_for('manage_total_electricity'))
+
+    message = 'Tổng điện tháng đã được cập nhật thành công!'
+    # Gửi từ htmx: chỉ trả về dòng vừa sửa để thay tại chỗ, không redirect + render lại cả trang
+    if is_htmx():
+        return htmx_response(render_template('_total_electricity_row.html', entry=entry), message)
+    flash(message, 'success')
     return redirect(url_for('manage_total_electricity'))
 
 @app.route('/delete_total_electricity/<int:entry_id>', methods=['POST'])
 @login_required
+@admin_required()
 def delete_total_electricity(entry_id):
-    if current_user.role != 'admin':
-        flash('Chỉ admin mới được truy cập', 'danger')
-        return redirect(url_for('dashboard'))
-    
-    entry = TotalElectricityMonth.query.get_or_404(entry_id)
+    entry = db.get_or_404(TotalElectricityMonth, entry_id)
     db.session.delete(entry)
     db.session.commit()
-    flash('Tổng điện tháng đã được xóa thành công!', 'success')
+    message = 'Tổng điện tháng đã được xóa thành công!'
+    # Gửi từ htmx: phản hồi rỗng → dòng bị xóa khỏi bảng
+    if is_htmx():
+        return htmx_response('', message)
+    flash(message, 'success')
     return redirect(url_for('manage_total_electricity'))
 
 @app.route('/manage_electricity_prices', methods=['GET', 'POST'])
 @login_required
+@admin_required()
 def manage_electricity_prices():
-    if current_user.role != 'admin':
-        flash('Chỉ admin mới được truy cập', 'danger')
-        return redirect(url_for('dashboard'))
-    
-    tiers = PriceTier.query.order_by(PriceTier.tier_order).all()
-    
     if request.method == 'POST':
         action = request.form.get('action')
         tier_id = request.form.get('tier_id')
         
+        # Sửa tất cả các bậc trong 1 lần gửi form: 1 lệnh UPDATE hàng loạt theo id, 1 commit,
+        # không SELECT bậc giá ra trước
         if action == 'edit':
-            tier = PriceTier.query.get_or_404(tier_id)
-            tier.tier_order = int(request.form['tier_order'])
-            tier.from_kwh = float(request.form['from_kwh'])
-            tier.to_kwh = float(request.form['to_kwh']) if request.form['to_kwh'] else None
-            tier.price = float(request.form['price'])
-            db.session.commit()
-            flash('Cập nhật bậc thành công!', 'success')
+            columns = [request.form.getlist(name) for name in ('tier_id', 'tier_order', 'from_kwh', 'to_kwh', 'price')]
+            # Mỗi bậc phải đủ 5 ô; số lượng lệch nhau → form hỏng, không zip cắt bớt / ghép sai bậc
+            if len({len(values) for values in columns}) != 1:
+                abort(400)
+            try:
+                rows = [
+                    {
+                        'id': int(row_id),
+                        'tier_order': int(tier_order),
+                        'from_kwh': float(from_kwh),
+                        'to_kwh': float(to_kwh) if to_kwh else None,
+                        'price': float(price),
+                    }
+                    for row_id, tier_order, from_kwh, to_kwh, price in zip(*columns)
+                ]
+            except ValueError:
+                flash('Dữ liệu bậc giá không hợp lệ, vui lòng kiểm tra lại', 'danger')
+                return redirect(url_for('manage_electricity_prices'))
+            try:
+                db.session.bulk_update_mappings(PriceTier, rows)
+                db.session.commit()
+            except StaleDataError:
+                # Có bậc đã bị xóa (vd: admin khác xóa trong lúc trang đang mở) → không lưu gì cả
+                db.session.rollback()
+                flash('Có bậc giá đã bị xóa, vui lòng tải lại trang', 'danger')
+                return redirect(url_for('manage_electricity_prices'))
+            flash(f'Đã cập nhật {len(rows)} bậc giá!', 'success')
         
         elif action == 'delete':
-            tier = PriceTier.query.get_or_404(tier_id)
-            db.session.delete(tier)
+            if not PriceTier.query.filter_by(id=tier_id).delete(synchronize_session=False):
+                abort(404)
             db.session.commit()
             flash('Xóa bậc thành công!', 'success')
         
         elif action == 'add':
+            # Để trống thứ tự bậc → DB tự gán max + 1 ngay trong câu INSERT (không SELECT trước)
+            tier_order = request.form.get('tier_order', '').strip()
             new_tier = PriceTier(
-                tier_order=int(request.form['tier_order']),
+                tier_order=int(tier_order) if tier_order else db.select(
+                    func.coalesce(func.max(PriceTier.tier_order), 0) + 1
+                ).scalar_subquery(),
                 from_kwh=float(request.form['from_kwh']),
                 to_kwh=float(request.form['to_kwh']) if request.form['to_kwh'] else None,
                 price=float(request.form['price'])
@@ -1009,7 +1454,15 @@ def manage_electricity_prices():
         
         return redirect(url_for('manage_electricity_prices'))
     
-    return render_template('manage_electricity_prices.html', tiers=tiers)
+    # Bảng giá vài tháng mới đổi 1 lần → trình duyệt giữ bản cũ, server chỉ trả 304.
+    # Dùng ETag (đúng trên mọi worker) thay vì cache trong tiến trình: admin vừa sửa giá
+    # phải thấy ngay bản mới dù request sau rơi vào worker khác
+    etag = make_etag(*data_version(PriceTier))
+    cached = not_modified(etag)
+    if cached:
+        return cached
+    tiers = PriceTier.query.order_by(PriceTier.tier_order).all()
+    return with_etag(render_template('manage_electricity_prices.html', tiers=tiers), etag)
 
 @app.route('/tenant_login', methods=['GET', 'POST'])
 def tenant_login():
@@ -1021,7 +1474,7 @@ def tenant_login():
         password = request.form.get('password', '')  # Mật khẩu có thể để trống nếu không đặt
         
         user = User.query.filter_by(username=username, role='tenant').first()
-        if user and (not user.password or check_password_hash(user.password, password)):
+        if user and (not user.password or verify_password(user, password)):
             login_user(user)
             return redirect(url_for('tenant_dashboard'))
         flash('Tên đăng nhập hoặc mật khẩu sai', 'danger')
@@ -1036,19 +1489,39 @@ def tenant_dashboard():
         logout_user()
         return redirect(url_for('tenant_login'))
     
-    tenant = Tenant.query.get(current_user.tenant_id)
+    tenant = db.session.get(Tenant, current_user.tenant_id, options=[joinedload(Tenant.room), *strict_loading()])
     if not tenant:
         flash('Không tìm thấy thông tin phòng', 'danger')
         logout_user()
         return redirect(url_for('tenant_login'))
     
-    room = Room.query.get(tenant.room_id)
-    contracts = Contract.query.filter_by(tenant_id=tenant.id).all()
-    bills = []
-    for contract in contracts:
-        bills.extend(Bill.query.filter_by(contract_id=contract.id).order_by(Bill.month.desc()).all())
+    room = tenant.room
+
+    # ETag theo riêng khách thuê này: (lần sửa bill gần nhất, số bill) của các hợp đồng của họ
+    # → trình duyệt tải lại trang mà dữ liệu không đổi thì chỉ nhận 304, không nạp danh sách bill
+    last_updated, total_bills = db.session.query(func.max(Bill.updated_at), func.count(Bill.id)).join(
+        Bill.contract
+    ).filter(Contract.tenant_id == tenant.id).one()
+
+    # Số trang tính từ COUNT ở trên, không cần thêm truy vấn đếm riêng
+    total_pages = max((total_bills + BILLS_PER_PAGE - 1) // BILLS_PER_PAGE, 1)
+    page = min(max(request.args.get('page', 1, type=int), 1), total_pages)
+
+    etag = make_etag(tenant.updated_at, room.updated_at, last_updated, total_bills, page)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    # Bill của tất cả hợp đồng của khách thuê trong 1 truy vấn JOIN
+    # (không cần nạp danh sách hợp đồng trước rồi lọc IN), chỉ lấy 1 trang, mới nhất trước
+    bills = Bill.query.join(Bill.contract).filter(
+        Contract.tenant_id == tenant.id
+    ).options(*strict_loading()).order_by(Bill.month.desc()).limit(BILLS_PER_PAGE).offset(
+        (page - 1) * BILLS_PER_PAGE
+    ).all()
     
-    return render_template('tenant_dashboard.html', tenant=tenant, room=room, bills=bills)
+    return with_etag(render_template('tenant_dashboard.html', tenant=tenant, room=room, bills=bills,
+                                     page=page, total_pages=total_pages), etag)
 
 @app.route('/tenant_logout')
 @login_required